@@ -1,28 +1,49 @@
 import requests
+import os
 import re
 import sys
 import time
 import shutil
+import functools
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
-from datetime import datetime, timedelta
+from email.utils import formatdate
 
 try:
-    import geoip2.database
+    import maxminddb
 except ImportError:
-    print("❌ geoip2 library is not installed.")
-    print("   Install command: pip install geoip2")
+    print("❌ maxminddb library is not installed.")
+    print("   Install command: pip install maxminddb")
     sys.exit(1)
 
 # ---------- UTF-8 console support ----------
 if hasattr(sys.stdout, "reconfigure"):
     sys.stdout.reconfigure(encoding="utf-8")  # type: ignore
 
+try:
+    import maxminddb.extension  # noqa: F401
+    GEOIP_READER_MODE = maxminddb.MODE_MMAP_EXT
+except ImportError:
+    print("⚠ maxminddb C extension is not available → falling back to slow pure-Python lookups")
+    print("   Install command: pip install 'maxminddb[extension]'")
+    GEOIP_READER_MODE = maxminddb.MODE_MMAP
+
+# Threads only overlap lookups when the C extension runs without the GIL
+PARALLEL_GEO_LOOKUPS = (
+    GEOIP_READER_MODE == maxminddb.MODE_MMAP_EXT
+    and not getattr(sys, "_is_gil_enabled", lambda: True)()
+)
+
 # ================= CONFIG =================
 SOURCE_URL = "https://raw.githubusercontent.com/x45fh56/tgs/refs/heads/main/Servers/Protocols/Categorized_Servers/1_VLESS_REALITY_TCP.txt"
 
 CHECK_IP_MODE = "geo"          # Options: "geo" | "api" | None/False
 SLEEP_BETWEEN_CHECKS = 0.7     # Delay only used in "api" mode
+GEO_WORKERS = 8                # Parallel lookups in "geo" mode
+GEO_BATCH_SIZE = 1000          # Links buffered per batch of parallel lookups
 
 # Directories
 DATA_DIR = Path("data")
@@ -43,8 +64,13 @@ BAD_ASN_KEYWORDS = [
     "contabo", "ionos", "scaleway", "oracle", "amazon aws",
     "google cloud", "microsoft azure"
 ]
+_BAD_ASN_RE = re.compile("|".join(map(re.escape, BAD_ASN_KEYWORDS)))
+
+_VLESS_HOST_RE = re.compile(r'vless://[^@]+@([^:/?#]+)')
+_IPV4_RE = re.compile(r'^(?:25[0-5]|2[0-4]\d|[01]?\d?\d)(?:\.(?:25[0-5]|2[0-4]\d|[01]?\d?\d)){3}\Z', re.ASCII)
 
-ip_cache = {}
+_geo_reader = None
+_geo_reader_lock = threading.Lock()
 
 # Output files (numbered for natural sorting in file explorers)
 FILES = {
@@ -62,18 +88,18 @@ def ensure_directories():
 
 def extract_ip(link):
     """Extract IPv4 address from vless link"""
-    match = re.match(r'vless://[^@]+@([^:/?#]+)', link)
+    match = _VLESS_HOST_RE.match(link)
     if match:
         host = match.group(1)
-        if re.match(r'^\d{1,3}(\.\d{1,3}){3}$', host):
+        if _IPV4_RE.match(host):
             return host
     return None
 
 def quick_filter(link):
     """Stage 1 filter: must be vless + reality + not websocket"""
-    link_lower = link.lower()
-    if not link_lower.startswith("vless://"):
+    if link[:8].lower() != "vless://":
         return False
+    link_lower = link.lower()
     if "security=reality" not in link_lower:
         return False
     if "type=ws" in link_lower:
@@ -82,22 +108,24 @@ def quick_filter(link):
 
 def should_download_geoip():
     """Check if GeoLite2-ASN database needs to be downloaded or updated"""
-    if not GEOIP_DATABASE_PATH.exists():
+    try:
+        st = GEOIP_DATABASE_PATH.stat()
+    except FileNotFoundError:
         return True
 
-    size = GEOIP_DATABASE_PATH.stat().st_size
+    size = st.st_size
     if size < MIN_DB_SIZE:
         print(f"⚠ Existing file too small ({size:,} bytes) → will re-download")
         return True
 
-    mod_time = datetime.fromtimestamp(GEOIP_DATABASE_PATH.stat().st_mtime)
-    age = datetime.now() - mod_time
+    age = time.time() - st.st_mtime
+    age_days = int(age // 86400)
 
-    if age > timedelta(days=MAX_AGE_DAYS):
-        print(f"⚠ Database is old ({age.days} days old) → manual update recommended")
-        return False  # Set to True if you want automatic update
+    if age > MAX_AGE_DAYS * 86400:
+        print(f"⚠ Database is old ({age_days} days old) → checking for update")
+        return True
 
-    print(f"✓ GeoLite2-ASN database found (age: {age.days} days, size: {size:,} bytes)")
+    print(f"✓ GeoLite2-ASN database found (age: {age_days} days, size: {size:,} bytes)")
     return False
 
 def download_geoip_database():
@@ -105,141 +133,238 @@ def download_geoip_database():
     if not should_download_geoip():
         return True
 
+    # Only ask for "not modified" when the local copy is usable as-is
+    headers = {}
+    try:
+        st = GEOIP_DATABASE_PATH.stat()
+        if st.st_size >= MIN_DB_SIZE:
+            headers["If-Modified-Since"] = formatdate(st.st_mtime, usegmt=True)
+    except FileNotFoundError:
+        pass
+
+    # Download next to the database so a failed refresh keeps the old copy
+    tmp_path = GEOIP_DATABASE_PATH.with_name(GEOIP_FILENAME + ".tmp")
+
     print(f"⏳ Downloading GeoLite2-ASN database to {DATA_DIR} ...")
     try:
-        with requests.get(GEOIP_URL, timeout=60, stream=True) as r:
+        with requests.get(GEOIP_URL, timeout=60, stream=True, headers=headers) as r:
+            if r.status_code == 304:
+                GEOIP_DATABASE_PATH.touch()
+                print(f"✓ {GEOIP_FILENAME} is up to date – nothing to download")
+                return True
             r.raise_for_status()
-            with open(GEOIP_DATABASE_PATH, 'wb') as f:
-                shutil.copyfileobj(r.raw, f)
+            with open(tmp_path, 'wb') as f:
+                r.raw.decode_content = True
+                shutil.copyfileobj(r.raw, f, length=1 << 20)
 
-        size = GEOIP_DATABASE_PATH.stat().st_size
+        size = tmp_path.stat().st_size
         if size >= MIN_DB_SIZE:
+            os.replace(tmp_path, GEOIP_DATABASE_PATH)
             print(f"✅ Download successful – {GEOIP_FILENAME} saved in {DATA_DIR}")
             return True
         else:
             print(f"❌ Downloaded file too small ({size:,} bytes)")
-            GEOIP_DATABASE_PATH.unlink(missing_ok=True)
-            return False
 
     except Exception as e:
         print(f"❌ Download failed: {e}")
-        GEOIP_DATABASE_PATH.unlink(missing_ok=True)
-        return False
+
+    tmp_path.unlink(missing_ok=True)
+    if headers:
+        print(f"⚠ Keeping existing {GEOIP_FILENAME}")
+        return True
+    GEOIP_DATABASE_PATH.unlink(missing_ok=True)
+    return False
+
+def get_reader():
+    """Return shared GeoLite2-ASN reader, opening it on first use"""
+    global _geo_reader
+    reader = _geo_reader
+    if reader is None:
+        with _geo_reader_lock:
+            if _geo_reader is None:
+                _geo_reader = maxminddb.open_database(str(GEOIP_DATABASE_PATH), GEOIP_READER_MODE)
+            reader = _geo_reader
+    return reader
+
+def close_reader():
+    """Close shared GeoLite2-ASN reader if it was opened"""
+    global _geo_reader
+    with _geo_reader_lock:
+        if _geo_reader is not None:
+            _geo_reader.close()
+            _geo_reader = None
+
+@functools.lru_cache(maxsize=100_000)
+def _asn_status(ip):
+    """Look up IP in GeoLite2-ASN and return cached verdict string"""
+    try:
+        record = get_reader().get(ip)
+        if record is None:
+            return "unknown"
+
+        org = (record.get("autonomous_system_organization") or "").lower()
+
+        is_bad = _BAD_ASN_RE.search(org) is not None
+
+        return "bad" if is_bad else "clean"
+
+    except Exception as e:
+        print(f"⚠ GeoASN error for {ip}: {e}")
+        return "error"
 
 def check_ip_with_geoasn(ip):
     """Check if IP belongs to suspicious ASN/datacenter using GeoLite2-ASN"""
-    if ip in ip_cache:
-        return ip_cache[ip]
-
     if not GEOIP_DATABASE_PATH.exists():
         if AUTO_DOWNLOAD_GEOIP:
             if not download_geoip_database():
-                ip_cache[ip] = "error"
                 return "error"
         else:
-            ip_cache[ip] = "no_db"
             return "no_db"
 
-    try:
-        with geoip2.database.Reader(str(GEOIP_DATABASE_PATH)) as reader:
-            response = reader.asn(ip)
-            org = (response.autonomous_system_organization or "").lower()
-            asn_str = str(response.autonomous_system_number or "")
-
-            is_bad = any(kw in org for kw in BAD_ASN_KEYWORDS) or any(kw in asn_str for kw in BAD_ASN_KEYWORDS)
+    return _asn_status(ip)
 
-            if is_bad:
-                ip_cache[ip] = "bad"
-                return "bad"
+def check_ips(ips, executor=None):
+    """Check unique IPs and return {ip: status}, in parallel when an executor is given"""
+    if not GEOIP_DATABASE_PATH.exists():
+        # Download was already attempted up front - don't retry it per IP;
+        # once the file is there, skip the per-IP check and go to the cache
+        return dict.fromkeys(ips, "error" if AUTO_DOWNLOAD_GEOIP else "no_db")
+
+    if executor is None:
+        statuses = {}
+        for ip in ips:
+            statuses[ip] = _asn_status(ip)
+            # Sleep only when using external API (rate limit protection)
+            if CHECK_IP_MODE == "api":
+                time.sleep(SLEEP_BETWEEN_CHECKS)
+        return statuses
+
+    return dict(zip(ips, executor.map(_asn_status, ips)))
+
+def open_outputs(stack):
+    """Open temporary output files; returns {key: file}"""
+    return {
+        key: stack.enter_context(
+            open(OUTPUT_DIR / (filename + ".tmp"), "w", encoding="utf-8", buffering=1 << 20)
+        )
+        for key, filename in FILES.items()
+    }
+
+def finish_outputs(success):
+    """Move temporary output files into place, or discard them on failure; returns saved keys"""
+    saved = []
+    for key, filename in FILES.items():
+        tmp_path = OUTPUT_DIR / (filename + ".tmp")
+        try:
+            if success:
+                os.replace(tmp_path, OUTPUT_DIR / filename)
+                saved.append(key)
             else:
-                ip_cache[ip] = "clean"
-                return "clean"
-
-    except geoip2.errors.AddressNotFoundError:  # type: ignore
-        ip_cache[ip] = "unknown"
-        return "unknown"
-    except Exception as e:
-        print(f"⚠ GeoASN error for {ip}: {e}")
-        ip_cache[ip] = "error"
-        return "error"
+                tmp_path.unlink(missing_ok=True)
+        except Exception as e:
+            print(f"✘ Error saving {filename}: {e}")
+            tmp_path.unlink(missing_ok=True)
+    return saved
+
+def classify_links(links, outputs, executor=None):
+    """Stage 1 filter + IP check in one pass, writing each link to its output file"""
+    counts = dict.fromkeys(FILES, 0)
+    seen = set()
+    pending = []  # (link, ip) waiting for a batched ASN lookup
+    report = []   # per-IP status lines, printed after the stage 1 summary
+
+    def emit(key, link):
+        outputs[key].write(link + "\n")
+        counts[key] += 1
+
+    def flush_pending():
+        statuses = check_ips(list(dict.fromkeys(ip for _, ip in pending if ip)), executor)
+        for link, ip in pending:
+            if not ip:
+                emit("isp_problem", link)
+                continue
+            status = statuses[ip]
+            if status == "clean":
+                emit("final", link)
+                report.append(f"  ✅ OK   | {ip}")
+            else:
+                emit("isp_problem", link)
+                report.append(f"  ❌ BAD  | {ip} → {status}")
+        pending.clear()
 
-def save_file(key, data):
-    """Save list of links to file in output directory"""
-    filename = FILES[key]
-    full_path = OUTPUT_DIR / filename
-    try:
-        with open(full_path, "w", encoding="utf-8") as f:
-            f.write("\n".join(data) + "\n")
-        print(f"✔ Saved: {filename} → {len(data)} links in output/")
-    except Exception as e:
-        print(f"✘ Error saving {filename}: {e}")
+    for link in links:
+        if link in seen:
+            continue
+        seen.add(link)
 
-def main():
-    ensure_directories()
+        # Stage 1: Quick filter
+        if not quick_filter(link):
+            emit("rejected", link)
+            continue
+        emit("stage1", link)
 
-    print("Starting VLESS server check...\n")
+        if CHECK_IP_MODE != "geo":
+            emit("final", link)
+            continue
 
-    # Download list of links
-    try:
-        r = requests.get(SOURCE_URL, timeout=15)
-        r.raise_for_status()
-        links = [l.strip() for l in r.text.splitlines() if l.strip() and not l.strip().startswith('#')]
-    except Exception as e:
-        print(f"❌ Failed to download link list: {e}")
-        return
+        pending.append((link, extract_ip(link)))
+        if len(pending) >= GEO_BATCH_SIZE:
+            flush_pending()
 
-    print(f"Received {len(links)} links")
+    if pending:
+        flush_pending()
 
-    stage1_pass = []
-    final_clean = []
-    isp_problem = []
-    rejected_stage1 = []
+    return len(seen), counts, report
 
-    # Stage 1: Quick filter
-    for link in links:
-        if quick_filter(link):
-            stage1_pass.append(link)
-        else:
-            rejected_stage1.append(link)
+def main():
+    ensure_directories()
 
-    print(f"Stage 1 (Reality + no WS): {len(stage1_pass)} links passed")
+    print("Starting VLESS server check...\n")
 
     if CHECK_IP_MODE != "geo":
         print("IP checking disabled or unknown mode → only stage 1 applied")
-        final_clean = stage1_pass[:]
     else:
         print("Starting IP check using GeoLite2-ASN...")
-        download_geoip_database()  # Downloads only if needed
+        if not download_geoip_database():  # Downloads only if needed
+            print("⚠ GeoLite2-ASN database unavailable → IP-checked links will be marked as suspicious")
 
-        for link in stage1_pass:
-            ip = extract_ip(link)
-            if not ip:
-                isp_problem.append(link)
-                continue
-
-            status = check_ip_with_geoasn(ip)
+    # Download list of links and classify them as they arrive
+    success = False
+    saved = []
+    try:
+        with requests.get(SOURCE_URL, timeout=15, stream=True) as r, ExitStack() as stack:
+            r.raise_for_status()
+            r.encoding = r.encoding or "utf-8"
+            outputs = open_outputs(stack)
+            executor = None
+            if CHECK_IP_MODE == "geo" and PARALLEL_GEO_LOOKUPS and GEOIP_DATABASE_PATH.exists():
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=GEO_WORKERS))
+            lines = (l.strip() for l in r.iter_lines(decode_unicode=True))
+            received, counts, report = classify_links(
+                (l for l in lines if l and not l.startswith('#')), outputs, executor
+            )
+        success = True
+    except Exception as e:
+        print(f"❌ Failed to process link list: {e}")
+        return
+    finally:
+        close_reader()
+        saved = finish_outputs(success)
 
-            if status == "clean":
-                final_clean.append(link)
-                print(f"  ✅ OK   | {ip}")
-            else:
-                isp_problem.append(link)
-                print(f"  ❌ BAD  | {ip} → {status}")
+    print(f"Received {received} links")
+    print(f"Stage 1 (Reality + no WS): {counts['stage1']} links passed")
 
-            # Sleep only when using external API (rate limit protection)
-            if CHECK_IP_MODE == "api":
-                time.sleep(SLEEP_BETWEEN_CHECKS)
+    if report:
+        sys.stdout.write("\n".join(report) + "\n")
 
     print("\n" + "═" * 60 + "\n")
 
-    save_file("stage1", stage1_pass)
-    save_file("final", final_clean)
-    save_file("isp_problem", isp_problem)
-    save_file("rejected", rejected_stage1)
+    for key in saved:
+        print(f"✔ Saved: {FILES[key]} → {counts[key]} links in output/")
 
     print("\nSummary:")
-    print(f"  • Ready to use (clean): {len(final_clean)}")
-    print(f"  • Suspicious ISP/datacenter: {len(isp_problem)}")
+    print(f"  • Ready to use (clean): {counts['final']}")
+    print(f"  • Suspicious ISP/datacenter: {counts['isp_problem']}")
     print("Files saved in output/ folder, database stored in data/ folder.")
 
 if __name__ == "__main__":